@@ -0,0 +1,147 @@
+#! /usr/bin/python
+
+''' Stream classification: run paths from stdin or a file list through the rules of a config.
+
+    Nothing is scanned, paths are read one at a time and a JSON record is written for
+    every rule that would act on them:
+        {"path": ..., "rule": "<operation>:<rule>", "destination": ..., "action": ...}
+
+    Rules are evaluated like Enforcer.enforce applies them: in config order,
+    and a file stops being classified once a rule moves it.
+'''
+import os
+import sys
+import json
+import argparse
+import contextlib
+from typing import BinaryIO, Iterator, List, Set, Tuple
+
+from main import Config, FileRule, File, Filter, Token, MOVE, load_config, apply_token
+
+def read_paths(stream: BinaryIO, delimiter: bytes = b"\n", chunk_size: int = 1 << 16) -> Iterator[str]:
+    ''' Yield delimited paths from a binary stream without reading it all into memory'''
+    pending = b""
+
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+
+        pending += chunk
+        *paths, pending = pending.split(delimiter)
+
+        for path in paths:
+            if path:
+                yield os.fsdecode(path)
+
+    if pending:
+        yield os.fsdecode(pending)
+
+def to_file(path: str) -> File:
+    ''' Build a File the same way scan_dir does, without touching the disk'''
+    (name, extension) = os.path.splitext(os.path.basename(path))
+    return File(name, extension.strip("."), os.path.abspath(path))
+
+def matches(file: File, rule: FileRule) -> bool:
+    ''' Same filtering order as Enforcer.filter_files: whitelist -> file extension -> key words'''
+    files = [file]
+
+    if rule.whitelist is not None:
+        files = Filter.by_whitelist(files, rule.whitelist)
+
+    if files and rule.extensions is not None:
+        files = Filter.by_extension(files, rule.extensions)
+
+    if files and rule.keywords is not None:
+        files = Filter.by_key_word(files, rule.keywords)
+
+    return files != []
+
+class Classifier():
+    ''' Matches single paths against the operations of a config.\n
+        If "ignore_sources" is False, an operation only sees paths that sit directly
+        inside one of its scan sources, just like a real scan.
+    '''
+    def __init__(self, config: Config, ignore_sources: bool = False):
+        self.config         = config
+        self.ignore_sources = ignore_sources
+        self.sources:       List[Set[str]] = [
+            {os.path.abspath(os.path.expanduser(source)) for source in operation.scan_sources}
+            for operation in config.operations
+        ]
+
+    def classify(self, path: str) -> Iterator[Tuple[str, FileRule, Token]]:
+        ''' Yield (rule id, rule, token) for every rule that would act on a path'''
+        file = to_file(path)
+        parent = os.path.dirname(file.path)
+
+        for (op_index, operation) in enumerate(self.config.operations):
+            if not self.ignore_sources and parent not in self.sources[op_index]:
+                continue
+
+            for (rule_index, rule) in enumerate(operation.rules):
+                if not matches(file, rule):
+                    continue
+
+                token = Token(file.path, rule.destination, rule.action)
+
+                # A file is never sent to the folder it is already in (see Token.is_valid)
+                if token.destination == parent:
+                    continue
+
+                yield (f"{op_index}:{rule_index}", rule, token)
+
+                if rule.action == MOVE:
+                    return
+
+def run(config: Config, stream: BinaryIO, out, delimiter: bytes = b"\n", ignore_sources: bool = False, execute: bool = False) -> int:
+    ''' Classify every path in a stream, returns the number of records written'''
+    classifier = Classifier(config, ignore_sources)
+    records = 0
+
+    for path in read_paths(stream, delimiter):
+        for (rule_id, rule, token) in classifier.classify(path):
+            record = {
+                "path":         token.source,
+                "rule":         rule_id,
+                "destination":  token.destination,
+                "action":       rule.action,
+            }
+            out.write(json.dumps(record) + "\n")
+            records += 1
+
+            if execute: # apply_token reports on stdout, keep it apart from the records
+                with contextlib.redirect_stdout(sys.stderr):
+                    apply_token(token)
+
+    return records
+
+def main(argv):
+    '''_'''
+    parser = argparse.ArgumentParser(description="Classify paths from a list instead of scanning folders.")
+    parser.add_argument("config", help="Config file")
+    parser.add_argument("paths", nargs="?", default="-", help="File with one path per entry, '-' for stdin (default)")
+    parser.add_argument("-0", "--null", action="store_true", help="Paths are NUL delimited (e.g. find -print0)")
+    parser.add_argument("--ignore-sources", action="store_true", help="Apply every operation regardless of its scan sources")
+    parser.add_argument("--execute", action="store_true", help="Also carry out the actions")
+    args = parser.parse_args(argv)
+
+    try:
+        config: Config = load_config(args.config)
+
+    except FileNotFoundError:
+        print(f"ERROR: Invalid path {args.config}", file=sys.stderr)
+        return
+
+    delimiter = b"\0" if args.null else b"\n"
+
+    if args.paths == "-":
+        run(config, sys.stdin.buffer, sys.stdout, delimiter, args.ignore_sources, args.execute)
+
+    else:
+        with open(args.paths, "rb") as stream:
+            run(config, stream, sys.stdout, delimiter, args.ignore_sources, args.execute)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
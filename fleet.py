@@ -0,0 +1,246 @@
+#! /usr/bin/python
+
+''' Fleet mode: apply one config template across many home directories.
+
+    Paths in a config are written relative to "~", which normally means the
+    home of whoever runs the sorter. Here "~" is rebound to each tree matched
+    by a root pattern (e.g. "/home/*") and every tree is sorted by a pool of
+    worker processes.
+
+    Every tree is sorted in its own process running as the owner of the tree,
+    and tokens that would leave the tree (e.g. through a symlink) are skipped.
+'''
+import os
+import sys
+import glob
+import time
+import argparse
+import contextlib
+import io
+import multiprocessing
+from typing import List, Optional
+
+from main import Config, FolderTemplate, Operation, FileRule, Enforcer, Token, load_config
+
+try: # Only needed to switch users, which is POSIX only
+    import pwd
+except ImportError:
+    pwd = None
+
+def rebind_path(path: Optional[str], home: str) -> Optional[str]:
+    ''' Replace a leading "~" with the given home directory.\n
+        Paths like "~other_user/..." and absolute paths are left untouched.
+    '''
+    if path is None:
+        return None
+
+    if path == "~":
+        return home
+
+    if path.startswith("~/") or path.startswith("~" + os.sep):
+        return os.path.join(home, path[2:])
+
+    return path
+
+def rebind_config(config: Config, home: str) -> Config:
+    ''' Returns a copy of a config where "~" refers to the given home directory'''
+    templates: List[FolderTemplate] = [
+        FolderTemplate(
+            root_folder         = rebind_path(template.root_folder, home),
+            folders             = template.folders,
+            place_for_unwanted  = rebind_path(template.place_for_unwanted, home)
+        )
+        for template in config.folder_templates
+    ]
+
+    operations: List[Operation] = [
+        Operation(
+            scan_sources    = [rebind_path(source, home) for source in operation.scan_sources],
+            rules           = [
+                FileRule(
+                    keywords    = rule.keywords,
+                    extensions  = rule.extensions,
+                    whitelist   = rule.whitelist,
+                    action      = rule.action,
+                    destination = rebind_path(rule.destination, home)
+                )
+                for rule in operation.rules
+            ]
+        )
+        for operation in config.operations
+    ]
+
+    return Config(templates, operations)
+
+def check_template(config: Config):
+    ''' Every path of a fleet config must start with "~".\n
+        Absolute paths would be shared by every tree, and every worker would race on them.
+    '''
+    paths = [template.root_folder for template in config.folder_templates]
+    paths += [template.place_for_unwanted for template in config.folder_templates if template.place_for_unwanted is not None]
+    paths += [source for operation in config.operations for source in operation.scan_sources]
+    paths += [rule.destination for operation in config.operations for rule in operation.rules]
+
+    for path in paths:
+        if not (path == "~" or path.startswith("~/") or path.startswith("~" + os.sep)):
+            raise Exception(f"Path '{path}' must start with '~' in fleet mode")
+
+def find_trees(root_pattern: str) -> List[str]:
+    ''' Expand a pattern such as "/home/*" into a sorted list of directories'''
+    return sorted(path for path in glob.glob(root_pattern) if os.path.isdir(path))
+
+def estimate_cost(config: Config) -> int:
+    ''' A cheap estimate of how much work a tree is: the number of entries in its scan sources.'''
+    cost = 0
+    sources = {source for operation in config.operations for source in operation.scan_sources}
+
+    for source in sources:
+        try:
+            with os.scandir(source) as entries:
+                cost += sum(1 for _ in entries)
+
+        except OSError:
+            pass
+
+    return cost
+
+class TreeSummary():
+    ''' Stores the outcome of sorting a single tree'''
+    def __init__(self, home: str, tokens: int, elapsed: float, error: Optional[str] = None, log: str = ""):
+        self.home       = home
+        self.tokens     = tokens
+        self.elapsed    = elapsed
+        self.error      = error
+        self.log        = log
+
+    def __repr__(self) -> str:
+        status = f"FAILED: {self.error}" if self.error is not None else "OK"
+        return f"{self.home}: {self.tokens} tokens in {self.elapsed:.2f}s [{status}]"
+
+def become_owner(home: str):
+    ''' Switch the current process to the user and group that own home.\n
+        Without root we can only sort trees we own.
+    '''
+    stat = os.stat(home)
+
+    if os.geteuid() != 0:
+        if stat.st_uid != os.geteuid():
+            raise Exception(f"'{home}' is owned by another user, run as root to sort it")
+        return
+
+    if stat.st_uid == 0:
+        return
+
+    try:
+        os.initgroups(pwd.getpwuid(stat.st_uid).pw_name, stat.st_gid)
+    except (KeyError, AttributeError): # No passwd entry, or no pwd module
+        os.setgroups([stat.st_gid])
+
+    os.setgid(stat.st_gid)
+    os.setuid(stat.st_uid)
+
+def inside(path: str, home: str) -> bool:
+    ''' Whether a path resolves (following symlinks) to somewhere inside home'''
+    real_home = os.path.realpath(home)
+    return os.path.commonpath([os.path.realpath(path), real_home]) == real_home
+
+def contained_tokens(tokens: List[Token], home: str) -> List[Token]:
+    ''' Drop tokens whose source or destination leaves home'''
+    contained: List[Token] = []
+
+    for token in tokens:
+        if inside(token.source, home) and (token.destination is None or inside(token.destination, home)):
+            contained.append(token)
+        else:
+            print(f"WARN: Skipped token leaving '{home}': {token.source} -> {token.destination}")
+
+    return contained
+
+def sort_tree(task) -> TreeSummary:
+    ''' Worker entry point: generate folders, scan, filter and enforce a single tree.\n
+        The worker becomes the owner of the tree first, so it can only touch what that user can.
+        Output from the enforcer is captured so workers do not interleave on stdout.
+    '''
+    (home, config) = task
+    enforcer = Enforcer(config)
+    error: Optional[str] = None
+    log = io.StringIO()
+    start = time.perf_counter()
+
+    with contextlib.redirect_stdout(log):
+        try:
+            become_owner(home)
+            enforcer.generate_folders()
+            enforcer.sort_folders()
+            enforcer.sort_files()
+            enforcer.tokens = contained_tokens(enforcer.tokens, home)
+            enforcer.enforce()
+
+        except Exception as err:
+            error = str(err)
+
+    return TreeSummary(home, len(enforcer.tokens), time.perf_counter() - start, error, log.getvalue())
+
+def run_fleet(config: Config, root_pattern: str, processes: Optional[int] = None) -> List[TreeSummary]:
+    ''' Sort every tree matched by root_pattern with a shared pool of workers.\n
+        Trees are queued largest first and handed out one at a time,
+        so an idle worker always steals the next pending tree instead of
+        waiting behind a fixed batch. This keeps large and small homes balanced across cores.
+        Each worker handles a single tree (maxtasksperchild=1) because it gives up root for it.
+    '''
+    check_template(config)
+
+    tasks = [(home, rebind_config(config, home)) for home in find_trees(root_pattern)]
+    tasks.sort(key=lambda task: estimate_cost(task[1]), reverse=True)
+
+    if tasks == []:
+        return []
+
+    summaries: List[TreeSummary] = []
+
+    with multiprocessing.Pool(processes, maxtasksperchild=1) as pool:
+        for summary in pool.imap_unordered(sort_tree, tasks, chunksize=1):
+            print(summary)
+            summaries.append(summary)
+
+    return summaries
+
+def main(argv):
+    '''_'''
+    parser = argparse.ArgumentParser(description="Apply one config across many home directories.")
+    parser.add_argument("config", help="Config template, paths should be prefixed with '~'")
+    parser.add_argument("root", help="Pattern matching the trees to sort, e.g. '/home/*'")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes (default: cpu count)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print the enforcer log of every tree")
+    args = parser.parse_args(argv)
+
+    try:
+        config: Config = load_config(args.config)
+
+    except FileNotFoundError:
+        print(f"ERROR: Invalid path {args.config}")
+        return
+
+    start = time.perf_counter()
+
+    try:
+        summaries = run_fleet(config, args.root, args.jobs)
+
+    except Exception as err:
+        print(f"ERROR: {err}")
+        return
+
+    elapsed = time.perf_counter() - start
+
+    if args.verbose:
+        for summary in summaries:
+            print(f"\n--- {summary.home} ---\n{summary.log}")
+
+    failed = [summary for summary in summaries if summary.error is not None]
+    tokens = sum(summary.tokens for summary in summaries)
+
+    print(f"\nSorted {len(summaries)} trees ({len(failed)} failed), {tokens} tokens in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
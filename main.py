@@ -6,7 +6,7 @@ import os.path
 import shutil
 import json
 import sys
-from typing import Iterable, List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
 DELETE = "DELETE"
 MOVE = "MOVE"
@@ -88,6 +88,21 @@ class FolderTemplate():
         '''Produces a list of folders with their raw path'''
         return map(lambda folder: os.path.join(self.root_folder, folder), self.folders)
 
+    @property
+    def as_tree(self) -> Dict[str, dict]:
+        ''' Nests the folders by level, e.g. ["Programs", "Programs/Python", "Misc/Fonts"] ->\n
+            {"Programs": {"Python": {}}, "Misc": {"Fonts": {}}}
+        '''
+        tree: Dict[str, dict] = {}
+
+        for folder in self.folders:
+            level = tree
+            for part in folder.replace(os.altsep or os.sep, os.sep).split(os.sep):
+                if part not in ("", "."):
+                    level = level.setdefault(part, {})
+
+        return tree
+
 class Operation():
     ''' Stores a list of sources and a list of rules'''
     def __init__(self, scan_sources: List[str], rules: List[FileRule]):
@@ -168,29 +183,38 @@ class Config():
 
 class Enforcer():
     '''Responsible for enforcing rules and configurations set up by the Config class.'''
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, scheduler = None):
         self.config:            Config          = config
+        self.scheduler                          = scheduler # (OPTIONAL) reorders and throttles tokens, see scheduler.py
         self.tokens:            List[Token]     = []
         self.files:             List[File]      = []
         self.folders:           List[Folder]    = []
         self.scanned_sources:   List[File]      = []
+        self.template_folders:  Dict[str, List[Folder]] = {} # root folder listings from generate_folders, reused by sort_folders
 
     def generate_folders(self):
-        '''Generates folders when provided a list of folder templates.'''
+        '''Generates folders when provided a list of folder templates.\n
+            Every directory of a template is listed once and only missing folders are created.
+        '''
         for folder_template in self.config.folder_templates:
-            for folder in folder_template.as_iter:
-                folder = os.path.expanduser(folder)
+            tree = folder_template.as_tree
+            if tree == {}:
+                continue
 
-                if os.path.exists(folder):
-                    print(f"INFO: Ignored folder (Already exists): '{folder}'.")
-                    continue
+            root = os.path.abspath(os.path.expanduser(folder_template.root_folder))
 
+            if not os.path.isdir(root):
                 try:
-                    os.makedirs(folder)
-                    print(f"INFO: Created folder: '{folder}'")
+                    os.makedirs(root)
+                    print(f"INFO: Created folder: '{root}'")
 
                 except Exception as err:
-                    print(f"WARN: Could not create folder: '{folder}', {err}")
+                    print(f"WARN: Could not create folder: '{root}', {err}")
+                    continue
+
+            scanned_folders = materialise_folders(root, tree)
+            if scanned_folders is not None:
+                self.template_folders[root] = scanned_folders
 
     def sort_folders(self):
         ''' Move folders not specified by the folder template to a specified folder.\n
@@ -203,10 +227,17 @@ class Enforcer():
             if template.place_for_unwanted is None:
                 continue
 
-            (_, scanned_folders) = scan_dir(template.root_folder)
+            root = os.path.abspath(os.path.expanduser(template.root_folder))
+
+            if root in self.template_folders:
+                scanned_folders = self.template_folders.pop(root)
+            else:
+                (_, scanned_folders) = scan_dir(template.root_folder)
+
+            wanted = set(template.as_tree) # Only the top level, "Programs/Python" keeps "Programs"
 
             for folder in scanned_folders:
-                if folder.name not in template.folders:
+                if folder.name not in wanted:
                     move_tokens.append(Token(
                         folder.path, template.place_for_unwanted, MOVE))
 
@@ -265,29 +296,13 @@ class Enforcer():
             print("\nThere's nothing to do!")
             return
 
-        for token in self.tokens:
-            if not token.is_valid():
-                # print("Skipped invalid token...")
-                continue
-
-            if token.action == DELETE:
-                # TODO: move to recycle bin
-                print("Deleting file not implemented...")
-                continue
-
-            if not os.path.exists(token.destination):
-                os.makedirs(token.destination)
-
-            src = check_and_rename_dupes(token.source, token.destination)
-
-            if token.action == MOVE:
-                move(src, token.destination)
+        tokens: Iterable[Token] = self.tokens
 
-            elif token.action == COPY:
-                copy(src, token.destination)
+        if self.scheduler is not None:
+            tokens = self.scheduler.schedule(self.tokens)
 
-            else:
-                print(f"Action:'{token.action}' not implemented.")
+        for token in tokens:
+            apply_token(token)
 
         print("\nDone!")
 
@@ -315,6 +330,122 @@ def scan_dir(folder: str) -> Tuple[List[File], List[Folder]]:
 
     return (scanned_files, scanned_folders)
 
+# Create folders relative to an open directory instead of resolving the full path every time
+USE_DIR_FD = os.open in os.supports_dir_fd and os.mkdir in os.supports_dir_fd and os.scandir in os.supports_fd
+
+def materialise_folders(root: str, tree: Dict[str, dict]) -> Optional[List[Folder]]:
+    ''' Create the missing folders of a template tree inside an existing root.\n
+        Each directory is listed once. Returns the folders found (or created) directly inside root,
+        or None if root could not be listed.
+    '''
+    if USE_DIR_FD:
+        try:
+            root_fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError as err:
+            _skip_level(root, tree, err)
+            return None
+
+        try:
+            entries = _materialise_level(root, root_fd, tree)
+        finally:
+            os.close(root_fd)
+
+    else:
+        entries = _materialise_level(root, root, tree)
+
+    if entries is None:
+        return None
+
+    return [Folder(name, os.path.join(root, name)) for (name, is_dir) in entries.items() if is_dir]
+
+def _materialise_level(path: str, handle, tree: Dict[str, dict]) -> Optional[Dict[str, bool]]:
+    ''' "handle" is a directory fd when USE_DIR_FD is set, otherwise the path itself.
+        Returns every entry name of this level and whether it is a folder, or None if it could not be listed.
+    '''
+    try:
+        with os.scandir(handle) as scanned:
+            entries = {entry.name: entry.is_dir() for entry in scanned}
+
+    except OSError as err:
+        _skip_level(path, tree, err)
+        return None
+
+    for (name, subtree) in tree.items():
+        folder = os.path.join(path, name)
+
+        if name in entries:
+            print(f"INFO: Ignored folder (Already exists): '{folder}'.")
+
+        else:
+            try:
+                if USE_DIR_FD:
+                    os.mkdir(name, dir_fd=handle)
+                else:
+                    os.mkdir(folder)
+
+                entries[name] = True
+                print(f"INFO: Created folder: '{folder}'")
+
+            except Exception as err:
+                print(f"WARN: Could not create folder: '{folder}', {err}")
+                continue
+
+        if subtree == {}:
+            continue
+
+        if not entries[name]:
+            print(f"WARN: Could not create folders in: '{folder}', it is not a folder")
+            continue
+
+        if USE_DIR_FD:
+            try:
+                child_fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY, dir_fd=handle)
+            except OSError as err:
+                _skip_level(folder, subtree, err)
+                continue
+
+            try:
+                _materialise_level(folder, child_fd, subtree)
+            finally:
+                os.close(child_fd)
+
+        else:
+            _materialise_level(folder, folder, subtree)
+
+    return entries
+
+def _skip_level(path: str, tree: Dict[str, dict], err: OSError):
+    ''' Report every folder of a tree that cannot be created because "path" cannot be opened'''
+    for (name, subtree) in tree.items():
+        folder = os.path.join(path, name)
+        print(f"WARN: Could not create folder: '{folder}', {err}")
+        _skip_level(folder, subtree, err)
+
+def apply_token(token: Token):
+    '''Carry out the action of a single token, invalid tokens are skipped'''
+    if not token.is_valid():
+        # print("Skipped invalid token...")
+        return
+
+    if token.action == DELETE:
+        # TODO: move to recycle bin
+        print("Deleting file not implemented...")
+        return
+
+    if not os.path.exists(token.destination):
+        os.makedirs(token.destination)
+
+    target = free_target(token.source, token.destination)
+
+    if token.action == MOVE:
+        move(token.source, target)
+
+    elif token.action == COPY:
+        copy(token.source, target)
+
+    else:
+        print(f"Action:'{token.action}' not implemented.")
+
 def move(src: str, dest: str):
     try:
         shutil.move(src, dest)
@@ -359,31 +490,26 @@ class Filter:
 
 # -------------------------!! Sloppy stuff, but works !!--------------------------
 
-def check_and_rename_dupes(source: str, destination: str) -> str:
-    ''' Renames a duplicate file/folder.
-        Needs refactoring
+def free_target(source: str, destination: str) -> str:
+    ''' Returns the path a file/folder should be moved or copied to inside destination.
+        If the name is taken, a number is added: "file.txt" -> "file (1).txt".
+        The source is never renamed, so later tokens for the same source still find it.
     '''
-    old_file = source
-    (path, file_name) = os.path.split(source)
-    potential_destination = os.path.join(destination, file_name)
-    path_exists = os.path.exists(potential_destination)
+    file_name = os.path.basename(source)
+    target = os.path.join(destination, file_name)
 
-    if not path_exists:
-        return source
+    if not os.path.exists(target):
+        return target
 
     generation = 1
-    (file_name, extension) = os.path.splitext(os.path.basename(file_name))
+    (name, extension) = os.path.splitext(file_name)
 
-    while path_exists:
-        new_file_name = f"{file_name} ({generation}){extension}"
-        potential_destination = os.path.join(destination, new_file_name)
-        path_exists = os.path.exists(potential_destination)
+    while os.path.exists(target):
+        target = os.path.join(destination, f"{name} ({generation}){extension}")
         generation += 1
 
-    new_source_path_name = os.path.join(path,new_file_name)
-    os.rename(old_file, new_source_path_name)
-    print(f"Renamed duplicate file: {source} -> {new_source_path_name}")
-    return new_source_path_name
+    print(f"Duplicate file name: {source} will be stored as {target}")
+    return target
 
 def load_config(config_path: str) -> Config:
     '''A rough implementation, creates a config class from a .json'''
@@ -442,18 +568,80 @@ def main(argv):
         print("ERROR: \n    You need to provide a config file! E.g. \"./configs/default.json\"")
         return
 
-    try:
-        param = argv[1]
+    profile_dir: Optional[str] = None
+    schedule:    Optional[str] = None
+    bandwidth:   Optional[str] = None
+    iops:        Optional[str] = None
+
+    for param in argv[1:]:
         if param == "-Q": # quiet mode, disables exit prompt
             exit_prompt = False
-    except: ## bad practice
-        pass         
-
-    test_conf = Enforcer(new_config)
-    test_conf.generate_folders()
-    test_conf.sort_folders()
-    test_conf.sort_files()
-    test_conf.enforce()
+
+        elif param == "--profile" or param.startswith("--profile="): # --profile or --profile=DIR
+            profile_dir = param.partition("=")[2] or "./profile"
+
+        elif param == "--schedule" or param.startswith("--schedule="): # --schedule or --schedule=POLICY
+            schedule = param.partition("=")[2] or "small-first"
+
+        elif param.startswith("--bandwidth="): # per device, e.g. --bandwidth=50M
+            bandwidth = param.partition("=")[2]
+
+        elif param.startswith("--iops="): # per device
+            iops = param.partition("=")[2]
+
+    scheduler = None
+    if schedule is not None or bandwidth is not None or iops is not None:
+        from scheduler import Scheduler, DeviceLimit, POLICIES, parse_size
+
+        policy = schedule or "fifo" # Limits on their own only throttle, they keep the config order
+        if policy not in POLICIES:
+            print(f"ERROR: Invalid schedule '{policy}', expected one of: {', '.join(POLICIES)}")
+            return
+
+        bytes_per_sec = operations = None
+
+        if bandwidth is not None:
+            try:
+                bytes_per_sec = parse_size(bandwidth)
+            except ValueError:
+                bytes_per_sec = 0
+
+            if not bytes_per_sec > 0:
+                print(f"ERROR: Invalid bandwidth '{bandwidth}', expected a positive size. E.g. \"50M\"")
+                return
+
+        if iops is not None:
+            try:
+                operations = float(iops)
+            except ValueError:
+                operations = 0
+
+            if not operations > 0:
+                print(f"ERROR: Invalid iops '{iops}', expected a positive number")
+                return
+
+        scheduler = Scheduler(policy, DeviceLimit(bytes_per_sec, operations))
+
+    test_conf = Enforcer(new_config, scheduler)
+    stages = [
+        ("generate_folders",    test_conf.generate_folders),
+        ("sort_folders",        test_conf.sort_folders),
+        ("sort_files",          test_conf.sort_files),
+        ("enforce",             test_conf.enforce),
+    ]
+
+    if profile_dir is None:
+        for (_, stage) in stages:
+            stage()
+
+    else:
+        from profiling import Profiler
+        profiler = Profiler(profile_dir, [os.path.realpath(__file__)])
+
+        for (name, stage) in stages:
+            profiler.run(name, stage)
+
+        profiler.dump()
 
     if exit_prompt:
         input("\nPress Enter to continue...")
@@ -0,0 +1,122 @@
+''' Profiling hooks used by "main.py --profile".
+
+    For every pipeline stage we record:
+    * cProfile stats -> "<stage>.pstats" (open with "python -m pstats").
+    * The top tracemalloc allocators in the sorter's own code.
+    * How many filesystem calls were made, by wrapping the os/shutil functions the enforcer uses.
+      Only calls made by the sorter are counted, not the calls shutil makes internally.
+
+    Everything except the pstats files is written to "profile.json".
+'''
+import os
+import json
+import time
+import shutil
+import cProfile
+import tracemalloc
+from typing import Callable, Dict, List
+
+# (module, attribute, label) of every call that is counted while a stage runs.
+FS_CALLS = [
+    (os.path,   "exists",   "os.path.exists"),
+    (os.path,   "isdir",    "os.path.isdir"),
+    (os,        "makedirs", "os.makedirs"),
+    (os,        "mkdir",    "os.mkdir"),
+    (os,        "open",     "os.open"),
+    (os,        "scandir",  "os.scandir"),
+    (os,        "rename",   "os.rename"),
+    (shutil,    "move",     "shutil.move"),
+    (shutil,    "copy",     "shutil.copy"),
+]
+
+class Profiler():
+    ''' Collects profiling data for each stage, then writes it to "profile_dir".\n
+        "trace_files" limits the reported allocators to these source files.
+    '''
+    def __init__(self, profile_dir: str, trace_files: List[str], top: int = 10):
+        self.profile_dir    = profile_dir
+        self.trace_files    = trace_files
+        self.top            = top
+        self.stages:        Dict[str, dict] = {}
+
+    def run(self, name: str, stage: Callable[[], None]):
+        ''' Run a single stage with profiling enabled'''
+        os.makedirs(self.profile_dir, exist_ok=True)
+
+        counts:     Dict[str, int] = {}
+        originals:  list           = []
+        depth:      List[int]      = [0] # shared by every wrapper, > 0 while a wrapped call runs
+
+        for (module, attr, label) in FS_CALLS:
+            original = getattr(module, attr)
+            originals.append((module, attr, original))
+            setattr(module, attr, count_calls(original, label, counts, depth))
+
+        profile = cProfile.Profile()
+        tracemalloc.start()
+        start = time.perf_counter()
+
+        try:
+            profile.runcall(stage)
+
+        finally:
+            elapsed = time.perf_counter() - start
+            snapshot = tracemalloc.take_snapshot()
+            (current, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            for (module, attr, original) in originals:
+                setattr(module, attr, original)
+
+            profile.dump_stats(os.path.join(self.profile_dir, f"{name}.pstats"))
+
+            self.stages[name] = {
+                "elapsed":          elapsed,
+                "memory_current":   current,
+                "memory_peak":      peak,
+                "fs_calls":         counts,
+                "top_allocators":   self.top_allocators(snapshot),
+            }
+
+    def top_allocators(self, snapshot: tracemalloc.Snapshot) -> List[dict]:
+        ''' Lines in "trace_files" that hold the most memory at the end of a stage'''
+        filters = [tracemalloc.Filter(True, path) for path in self.trace_files]
+        statistics = snapshot.filter_traces(filters).statistics("lineno")
+
+        return [
+            {
+                "file":     stat.traceback[0].filename,
+                "line":     stat.traceback[0].lineno,
+                "size":     stat.size,
+                "count":    stat.count,
+            }
+            for stat in statistics[:self.top]
+        ]
+
+    def dump(self):
+        ''' Write the collected data to "profile.json"'''
+        os.makedirs(self.profile_dir, exist_ok=True)
+        file_path = os.path.join(self.profile_dir, "profile.json")
+
+        with open(file_path, "w", encoding="UTF-8") as out_file:
+            json.dump({"stages": self.stages}, out_file, indent = 2)
+
+        print(f"INFO: Profile written to '{self.profile_dir}'")
+
+def count_calls(function: Callable, name: str, counts: Dict[str, int], depth: List[int]) -> Callable:
+    ''' Wrap a function so every top level call increments counts[name].\n
+        Calls made while another wrapped call is running (e.g. os.rename inside shutil.move) are not counted.
+    '''
+    counts.setdefault(name, 0)
+
+    def wrapper(*args, **kwargs):
+        if depth[0] == 0:
+            counts[name] += 1
+
+        depth[0] += 1
+        try:
+            return function(*args, **kwargs)
+        finally:
+            depth[0] -= 1
+
+    return wrapper
@@ -0,0 +1,327 @@
+''' An I/O aware scheduler that sits between token generation and enforcement.
+
+    Tokens are only reordered where that cannot change the outcome. A token always runs after:
+    * earlier tokens with the same source, so the first rule that matched a file still wins.
+    * earlier tokens putting a file with the same name into its destination, so duplicates are numbered the same.
+    * earlier tokens putting a file with the same name into the folder of its source, and the other way around.
+    * earlier folder moves (and folder moves after every earlier token), as a folder may hold other sources.
+    Names are compared without their " (n)" duplicate numbers and case, "x (1).txt" may collide with "x.txt".
+
+    Of the tokens that are ready, same-device renames (and anything else that moves no data)
+    go first in their original order. Copies and cross-device moves follow, ordered by a priority
+    policy and throttled by per-device bytes/sec and IOPS limits.
+    The "physical" policy reads sources in on-disk order to minimise seeks on HDDs.
+'''
+import os
+import re
+import time
+import heapq
+import struct
+from stat import S_ISDIR
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from main import Token, MOVE, COPY
+
+try: # FIEMAP is Linux only
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FS_IOC_FIEMAP       = 0xC020660B
+FIEMAP_HEADER       = struct.Struct("=QQIIII")          # fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved
+FIEMAP_EXTENT       = struct.Struct("=QQQQQIIII")       # fe_logical, fe_physical, fe_length, reserved64[2], fe_flags, reserved[3]
+FIEMAP_FLAG_SYNC    = 0x1 # flush delayed allocations first, or they have no physical offset yet
+FIEMAP_EXTENT_UNKNOWN   = 0x2
+FIEMAP_EXTENT_DELALLOC  = 0x4
+
+class DeviceLimit():
+    ''' Throughput limits for a single device.\n
+        "bytes_per_sec" and "iops" are optional, None means unlimited.
+    '''
+    def __init__(self, bytes_per_sec: Optional[float] = None, iops: Optional[float] = None):
+        self.bytes_per_sec  = bytes_per_sec
+        self.iops           = iops
+
+class Throttle():
+    ''' Paces work on a device so it never exceeds its DeviceLimit.\n
+        Each transfer books "size / bytes_per_sec" (and "1 / iops") seconds of the device,
+        the next transfer waits until the device is free again.
+    '''
+    def __init__(self, limit: DeviceLimit, clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.limit      = limit
+        self.clock      = clock
+        self.sleep      = sleep
+        self.free_at    = 0.0
+
+    def wait(self, size: int):
+        ''' Block until the device has room for a transfer of "size" bytes'''
+        now = self.clock()
+
+        if self.free_at > now:
+            self.sleep(self.free_at - now)
+            now = self.free_at
+
+        busy = 0.0
+        if self.limit.bytes_per_sec:
+            busy = max(busy, size / self.limit.bytes_per_sec)
+
+        if self.limit.iops:
+            busy = max(busy, 1 / self.limit.iops)
+
+        self.free_at = now + busy
+
+class Job():
+    ''' A token and what the scheduler knows about it'''
+    def __init__(self, index: int, token: Token):
+        self.index      = index # position in the original token list
+        self.token      = token
+        self.size       = 0
+        self.src_dev:   Optional[int] = None
+        self.dest_dev:  Optional[int] = None
+        self.inode      = 0
+        self.extent:    Optional[int] = None # physical offset of the first extent, if known
+        self.fast       = True
+        self.waiting    = 0 # number of jobs that must run first
+        self.next:      List["Job"] = []
+
+    def after(self, jobs: Iterable["Job"]):
+        ''' This job must wait for all of these jobs'''
+        for job in set(jobs):
+            if job is not self:
+                job.next.append(self)
+                self.waiting += 1
+
+# Priority policies for the transfer lane. Ties keep their original order.
+POLICIES: Dict[str, Callable[[Job], object]] = {
+    "small-first":  lambda job: job.size,
+    "large-first":  lambda job: -job.size,
+    "fifo":         lambda job: 0,
+    # Seek optimised for HDDs: read in on-disk order, falling back to inode order
+    "physical":     lambda job: (job.src_dev, job.extent is None, job.extent or 0, job.inode),
+}
+
+class Scheduler():
+    ''' Orders tokens by lane and priority, and throttles transfers while they are enforced.\n
+        "limits" maps a path on a device to the limits of that device,
+        "default_limit" applies to every other device.
+    '''
+    def __init__(
+        self,
+        policy:         str = "small-first",
+        default_limit:  Optional[DeviceLimit] = None,
+        limits:         Optional[Dict[str, DeviceLimit]] = None,
+    ):
+        if policy not in POLICIES:
+            raise Exception(f"Unknown scheduling policy '{policy}', expected one of {list(POLICIES)}")
+
+        self.policy         = policy
+        self.default_limit  = default_limit if default_limit is not None else DeviceLimit()
+        self.limits:        Dict[int, DeviceLimit] = {}
+        self.throttles:     Dict[int, Throttle]    = {}
+
+        for (path, limit) in (limits or {}).items():
+            self.limits[device_of(path)] = limit
+
+    def plan(self, tokens: List[Token]) -> List[Job]:
+        ''' Measure every token and link it to the tokens it must wait for'''
+        jobs = [Job(index, token) for (index, token) in enumerate(tokens)]
+        stats: Dict[str, Optional[os.stat_result]] = {}
+
+        last_of_source: Dict[str, Job]                      = {}
+        last_writer:    Dict[Tuple[str, str], Job]          = {} # last job putting a file with this name into a folder
+        readers:        Dict[Tuple[str, str], List[Job]]    = {} # jobs relying on this name in a folder since its last writer
+        barrier:        Optional[Job]                       = None
+        since_barrier:  List[Job]                           = []
+
+        for job in jobs:
+            token = job.token
+
+            if token.source not in stats:
+                try:
+                    stats[token.source] = os.stat(token.source)
+                except OSError: # The enforcer will skip it as an invalid token
+                    stats[token.source] = None
+
+            self.measure(job, stats[token.source])
+
+            before: List[Job] = []
+
+            if token.source in last_of_source:
+                before.append(last_of_source[token.source])
+            last_of_source[token.source] = job
+
+            reads = [name_key(token.source)]
+            writes = []
+
+            if token.action in (MOVE, COPY) and token.destination is not None:
+                writes.append(name_key(os.path.join(token.destination, os.path.basename(token.source))))
+
+                # The destination and its parents may be created, a file of the same name must not be put there first
+                folder = os.path.abspath(token.destination)
+                while os.path.dirname(folder) != folder:
+                    reads.append(name_key(folder))
+                    folder = os.path.dirname(folder)
+
+            for key in reads:
+                if key in last_writer:
+                    before.append(last_writer[key])
+                readers.setdefault(key, []).append(job)
+
+            for key in writes:
+                if key in last_writer:
+                    before.append(last_writer[key])
+                before += readers.pop(key, [])
+                last_writer[key] = job
+
+            stat = stats[token.source]
+            if stat is not None and S_ISDIR(stat.st_mode):
+                before += since_barrier
+                if barrier is not None:
+                    before.append(barrier)
+                barrier = job
+                since_barrier = []
+
+            elif barrier is not None:
+                before.append(barrier)
+
+            if barrier is not job:
+                since_barrier.append(job)
+
+            job.after(before)
+
+        return jobs
+
+    def measure(self, job: Job, stat: Optional[os.stat_result]):
+        ''' Find the devices a token touches and, if it moves data, how many bytes'''
+        token = job.token
+
+        if stat is None or token.action not in (MOVE, COPY) or token.destination is None:
+            return
+
+        job.src_dev     = stat.st_dev
+        job.inode       = stat.st_ino
+        job.dest_dev    = device_of(token.destination)
+
+        if token.action == COPY or job.dest_dev != job.src_dev:
+            job.fast = False
+            job.size = size_of(token.source)
+
+            if self.policy == "physical":
+                job.extent = first_extent(token.source)
+
+    def order(self, jobs: List[Job]) -> Iterator[Job]:
+        ''' Yield jobs once everything they wait for has been yielded.
+            Ready renames go first in their original order, then ready transfers by priority.
+        '''
+        key = POLICIES[self.policy]
+        ready: list = []
+
+        def push(job: Job):
+            if job.fast:
+                heapq.heappush(ready, (0, 0, job.index, job))
+            else:
+                heapq.heappush(ready, (1, key(job), job.index, job))
+
+        for job in jobs:
+            if job.waiting == 0:
+                push(job)
+
+        while ready:
+            job = heapq.heappop(ready)[-1]
+            yield job
+
+            for waiting in job.next:
+                waiting.waiting -= 1
+                if waiting.waiting == 0:
+                    push(waiting)
+
+    def schedule(self, tokens: List[Token]) -> Iterator[Token]:
+        ''' Yield tokens in their scheduled order, waiting before each transfer if a device is busy.\n
+            A token is only yielded after the previous one was enforced, so its dependencies are done.
+        '''
+        for job in self.order(self.plan(tokens)):
+            if not job.fast:
+                for device in {job.src_dev, job.dest_dev}:
+                    self.throttle(device).wait(job.size)
+
+            yield job.token
+
+    def throttle(self, device: int) -> Throttle:
+        if device not in self.throttles:
+            self.throttles[device] = Throttle(self.limits.get(device, self.default_limit))
+
+        return self.throttles[device]
+
+def name_key(path: str) -> Tuple[str, str]:
+    ''' (folder, name) of a path, without duplicate numbers: "Music/X (1).mp3" -> ("music", "x.mp3")'''
+    path = os.path.abspath(path)
+    (name, extension) = os.path.splitext(os.path.basename(path))
+    name = re.sub(r"( \(\d+\))+$", "", name)
+
+    return (os.path.dirname(path).lower(), f"{name}{extension}".lower())
+
+def device_of(path: str) -> int:
+    ''' The device of a path, or of its closest existing parent if it does not exist yet'''
+    path = os.path.abspath(os.path.expanduser(path))
+
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+
+    return os.stat(path).st_dev
+
+def size_of(path: str) -> int:
+    ''' Size of a file, or the total size of the files in a folder'''
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    total = 0
+    for (root, _, files) in os.walk(path):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+
+    return total
+
+def first_extent(path: str) -> Optional[int]:
+    ''' Physical offset of the first extent of a file, using the FIEMAP ioctl.\n
+        Returns None for folders, empty files, extents without a known location, or if FIEMAP is not supported.
+    '''
+    if fcntl is None or os.path.isdir(path):
+        return None
+
+    request = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+    FIEMAP_HEADER.pack_into(request, 0, 0, 0xFFFFFFFFFFFFFFFF, FIEMAP_FLAG_SYNC, 0, 1, 0)
+
+    try:
+        with open(path, "rb") as file:
+            fcntl.ioctl(file.fileno(), FS_IOC_FIEMAP, request)
+
+    except OSError:
+        return None
+
+    mapped_extents = FIEMAP_HEADER.unpack_from(request, 0)[3]
+    if mapped_extents == 0:
+        return None
+
+    extent = FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)
+    (physical, flags) = (extent[1], extent[5])
+
+    if flags & (FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DELALLOC):
+        return None
+
+    return physical
+
+def parse_size(text: str) -> float:
+    ''' Parse sizes such as "500", "64K", "50M" or "1G" into bytes'''
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper().rstrip("B")
+
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+
+    return float(text)
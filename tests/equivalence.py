@@ -0,0 +1,289 @@
+''' Differential equivalence harness for sorting engines.
+
+    A seed generates a synthetic tree and a config: odd file names, regex
+    metacharacters in keywords, extensionless files, whitelist hits,
+    many files with the same name, and the same name copied then moved
+    from one source while another source moves it to the same folder. The reference pipeline and a candidate
+    engine run on identical copies in temporary folders, and their effective
+    tokens and final trees must be the same.
+
+    python tests/equivalence.py [ENGINE] [RUNS]
+'''
+import os
+import re
+import sys
+import time
+import random
+import tempfile
+import contextlib
+import io
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+import scheduler
+import classify
+
+ROOT = "<root>"
+
+NAMES       = ["report", "Screenshot 2022", "wallpaper", "a", "b (1)", "c++", "notes.v2", "linux-6.0",
+               "ünïcode", "[draft]", "icon", ".hidden", "UPPER", "dup", "dup", "dup", "x.y.z", "file name"]
+EXTENSIONS  = ["mp3", "MP3", "zip", "tar.gz", "txt", "py", "", "", "jpg", "torrent"]
+KEYWORDS    = ["screenshot", "wallpaper", "linux", "dup", "c\\+\\+", "a.c", "^b", "e$", "[dr]", "", "Upper"]
+FOLDERS     = ["Music", "Compressed", "Programs", "Programs/Python", "Pictures", "Misc/No extension", "Unsorted"]
+SOURCES     = ["Downloads", "Downloads/Unsorted", "Desktop"]
+CLASH_SOURCES = ["Downloads", "Desktop"]
+
+def generate_tree(rng: random.Random) -> Dict[str, bytes]:
+    ''' Relative file paths and their contents. Names often repeat to cause collisions.'''
+    tree: Dict[str, bytes] = {}
+
+    for index in range(rng.randint(0, 40)):
+        folder      = rng.choice(SOURCES + ["Downloads/Music", "Downloads/Old stuff", "Downloads/Programs/Python"])
+        name        = rng.choice(NAMES)
+        extension   = rng.choice(EXTENSIONS)
+        file_name   = f"{name}.{extension}" if extension else name
+
+        tree.setdefault(os.path.join(folder, file_name), f"{index}".encode())
+
+    if rng.random() < 0.5: # Matched by the clash operations of generate_config
+        for folder in CLASH_SOURCES:
+            tree[os.path.join(folder, "clash.mp3")] = folder.encode()
+
+    return tree
+
+def generate_config(rng: random.Random, root: str) -> main.Config:
+    ''' A random config with every path inside root'''
+    path = lambda relative: os.path.join(root, relative)
+
+    templates = [
+        main.FolderTemplate(
+            path("Downloads"),
+            rng.sample(FOLDERS, rng.randint(0, len(FOLDERS))),
+            rng.choice([None, path("Downloads/Folders")])
+        )
+    ]
+
+    operations = []
+    for _ in range(rng.randint(1, 3)):
+        rules = []
+
+        for _ in range(rng.randint(1, 5)):
+            extensions  = rng.choice([None, rng.sample(EXTENSIONS, rng.randint(1, 3))])
+            keywords    = rng.choice([None, rng.sample(KEYWORDS, rng.randint(1, 2))]) if extensions else rng.sample(KEYWORDS, 1)
+
+            if rng.random() < 0.01: # keywords are not escaped, both engines must fail the same way
+                keywords = ["["]
+
+            rules.append(main.create_file_rule(
+                path(os.path.join("Downloads", rng.choice(FOLDERS))),
+                extensions  = extensions,
+                keywords    = keywords,
+                whitelist   = rng.choice([None, rng.sample(NAMES, 2)]),
+                action      = rng.choice([main.MOVE, main.MOVE, main.MOVE, main.COPY]),
+            ))
+
+        operations.append(main.Operation([path(source) for source in rng.sample(SOURCES, rng.randint(1, 2))], rules))
+
+    if rng.random() < 0.5: # One source copies then moves "clash.mp3", another moves the same name into the copy's folder
+        (first, second) = rng.sample(CLASH_SOURCES, 2)
+        (copy_to, move_to) = rng.sample(FOLDERS, 2)
+        clash = lambda folder, action: main.create_file_rule(
+            path(os.path.join("Downloads", folder)), ["mp3"], ["clash"], action=action)
+
+        position = rng.randint(0, len(operations))
+        operations[position:position] = [
+            main.Operation([path(first)],  [clash(copy_to, main.COPY), clash(move_to, main.MOVE)]),
+            main.Operation([path(second)], [clash(copy_to, main.MOVE)]),
+        ]
+
+    return main.Config(templates, operations)
+
+class Engine():
+    ''' A sorting engine: "plan" generates tokens, "enforce" carries them out.\n
+        This is the reference pipeline, alternatives override either step.
+        Engines that reorder tokens set "exact" to False, duplicates may then be numbered differently.
+        Engines that skip rules the reference still evaluates set "strict_errors" to False,
+        seeds where the reference fails (e.g. on an invalid keyword) are then skipped.
+    '''
+    exact           = True
+    strict_errors   = True
+
+    def __init__(self, config: main.Config):
+        self.enforcer = main.Enforcer(config)
+
+    def plan(self) -> List[main.Token]:
+        self.enforcer.generate_folders()
+        self.enforcer.sort_folders()
+        self.enforcer.sort_files()
+        return self.enforcer.tokens
+
+    def enforce(self, tokens: List[main.Token]):
+        self.enforcer.tokens = tokens
+        self.enforcer.enforce()
+
+class SchedulerEngine(Engine):
+    ''' Reference plan, enforced through the I/O scheduler'''
+    policy = "fifo"
+
+    def __init__(self, config: main.Config):
+        super().__init__(config)
+        self.enforcer.scheduler = scheduler.Scheduler(self.policy)
+
+def scheduler_engine(policy: str) -> Callable[[main.Config], Engine]:
+    ''' A SchedulerEngine using the given policy'''
+    return type(f"SchedulerEngine[{policy}]", (SchedulerEngine,), {"policy": policy})
+
+class ClassifyEngine(Engine):
+    ''' File tokens come from the stream classifier fed with a listing of the scan sources'''
+    exact           = False
+    strict_errors   = False # a file is not classified further once it is moved
+
+    def plan(self) -> List[main.Token]:
+        self.enforcer.generate_folders()
+        self.enforcer.sort_folders()
+
+        classifier = classify.Classifier(self.enforcer.config)
+        sources = [source for operation in self.enforcer.config.operations for source in operation.scan_sources]
+        paths: List[str] = []
+
+        for source in dict.fromkeys(sources):
+            (files, _) = main.scan_dir(source)
+            paths += [file.path for file in files]
+
+        for path in paths:
+            self.enforcer.tokens += [token for (_, _, token) in classifier.classify(path)]
+
+        return self.enforcer.tokens
+
+ENGINES: Dict[str, Callable[[main.Config], Engine]] = {
+    "reference":    Engine,
+    "classify":     ClassifyEngine,
+    **{f"scheduler-{policy}": scheduler_engine(policy) for policy in scheduler.POLICIES},
+}
+
+class Outcome():
+    ''' What an engine did to a tree'''
+    def __init__(self, tokens: List[Tuple[str, str, str]], state: Dict[str, Optional[bytes]], error: Optional[str], elapsed: float):
+        self.tokens     = tokens
+        self.state      = state
+        self.error      = error
+        self.elapsed    = elapsed
+
+def effective_tokens(tokens: List[main.Token], root: str) -> List[Tuple[str, str, str]]:
+    ''' Tokens that can have an effect, sorted and relative to root.\n
+        Tokens that send a file to the folder it is in, or that follow a MOVE of the
+        same source, are no-ops in every engine and are dropped.
+    '''
+    effective = []
+    moved = set()
+
+    for token in tokens:
+        if token.source in moved or token.destination == os.path.dirname(token.source):
+            continue
+
+        if token.action == main.MOVE:
+            moved.add(token.source)
+
+        effective.append((token.source.replace(root, ROOT), token.destination.replace(root, ROOT), token.action))
+
+    return sorted(effective)
+
+def snapshot(root: str) -> Dict[str, Optional[bytes]]:
+    ''' Every folder (None) and file (its contents) below root'''
+    state: Dict[str, Optional[bytes]] = {}
+
+    for (folder, folders, files) in os.walk(root):
+        for name in folders:
+            state[os.path.relpath(os.path.join(folder, name), root)] = None
+
+        for name in files:
+            with open(os.path.join(folder, name), "rb") as file:
+                state[os.path.relpath(os.path.join(folder, name), root)] = file.read()
+
+    return state
+
+def without_generations(state: Dict[str, Optional[bytes]]) -> List[Tuple[str, str, Optional[bytes]]]:
+    ''' A tree with the " (n)" suffixes of renamed duplicates removed, for engines that may order collisions differently'''
+    strip = lambda name: re.sub(r"( \(\d+\))+(?=\.[^.]*$|$)", "", name)
+    return sorted(((os.path.dirname(path), strip(os.path.basename(path)), data) for (path, data) in state.items()),
+        key=lambda entry: (entry[0], entry[1], entry[2] or b""))
+
+def run_engine(engine: Callable[[main.Config], Engine], seed: int) -> Outcome:
+    ''' Build the tree and config of a seed in a fresh folder and sort it'''
+    rng = random.Random(seed)
+    tree = generate_tree(rng)
+
+    with tempfile.TemporaryDirectory() as root:
+        config = generate_config(rng, root)
+
+        for source in SOURCES:
+            os.makedirs(os.path.join(root, source), exist_ok=True)
+
+        for (path, data) in tree.items():
+            os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+            with open(os.path.join(root, path), "wb") as file:
+                file.write(data)
+
+        tokens: List[Tuple[str, str, str]] = []
+        error: Optional[str] = None
+        start = time.perf_counter()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                instance = engine(config)
+                planned = instance.plan()
+                tokens = effective_tokens(planned, root)
+                instance.enforce(planned)
+
+            except Exception as err:
+                error = f"{type(err).__name__}: {err}".replace(root, ROOT)
+
+        elapsed = time.perf_counter() - start
+        return Outcome(tokens, snapshot(root), error, elapsed)
+
+def check_equivalence(candidate: Callable[[main.Config], Engine], seed: int) -> Optional[Tuple[Outcome, Outcome]]:
+    ''' Run the reference and a candidate engine on the same seed.\n
+        Raises AssertionError on the first difference, returns None if the seed is skipped.
+    '''
+    reference = run_engine(Engine, seed)
+    outcome = run_engine(candidate, seed)
+
+    if reference.error is not None and not candidate.strict_errors:
+        return None
+
+    assert outcome.error == reference.error, f"seed {seed}: error {outcome.error!r} != {reference.error!r}"
+    assert outcome.tokens == reference.tokens, f"seed {seed}: token sets differ"
+
+    if candidate.exact:
+        assert outcome.state == reference.state, f"seed {seed}: final trees differ"
+    else:
+        assert without_generations(outcome.state) == without_generations(reference.state), f"seed {seed}: final trees differ"
+
+    return (reference, outcome)
+
+def compare(name: str, runs: int):
+    ''' Check an engine over many seeds and report the speedup over the reference'''
+    reference_time = candidate_time = 0.0
+    skipped = 0
+
+    for seed in range(runs):
+        outcomes = check_equivalence(ENGINES[name], seed)
+
+        if outcomes is None:
+            skipped += 1
+            continue
+
+        (reference, outcome) = outcomes
+        reference_time += reference.elapsed
+        candidate_time += outcome.elapsed
+
+    speedup = f"x{reference_time / candidate_time:.2f}" if candidate_time > 0 else "n/a" # nothing compared
+    print(f"{name}: {runs - skipped} runs equivalent ({skipped} skipped), reference {reference_time:.3f}s, candidate {candidate_time:.3f}s, "
+        f"speedup {speedup}")
+
+
+if __name__ == "__main__":
+    engine_name = sys.argv[1] if len(sys.argv) > 1 else "scheduler-small-first"
+    compare(engine_name, int(sys.argv[2]) if len(sys.argv) > 2 else 100)
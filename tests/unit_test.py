@@ -1,5 +1,10 @@
 import unittest
 import main
+import fleet
+import profiling
+import scheduler
+import classify
+import equivalence
 # python -m unittest unit_test.py
 class Testclass(unittest.TestCase):
     '''testing'''
@@ -86,6 +91,458 @@ class Testclass(unittest.TestCase):
         move_token_2 = main.Token(this_code_folder, test_destination, "MOVE")
         self.assertFalse(move_token_2.is_valid())
 
+    def test_free_target(self):
+        '''Taken names are numbered in the destination, the source is left alone'''
+        import os
+        import io
+        import tempfile
+        import contextlib
+
+        with tempfile.TemporaryDirectory() as root:
+            source = os.path.join(root, "x.txt")
+            destination = os.path.join(root, "dest")
+            os.makedirs(destination)
+            open(source, "w").close()
+
+            expected = ["x.txt", "x (1).txt", "x (2).txt"]
+            for name in expected:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    target = main.free_target(source, destination)
+
+                self.assertEqual(target, os.path.join(destination, name))
+                open(target, "w").close()
+
+            self.assertTrue(os.path.exists(source))
+            self.assertEqual(sorted(os.listdir(destination)), sorted(expected))
+
+    def test_fleet_rebind_home(self):
+        '''Paths starting with "~" must point into the rebound home, other paths are untouched'''
+        home = "/home/alice"
+
+        self.assertEqual(fleet.rebind_path("~", home),              home)
+        self.assertEqual(fleet.rebind_path("~/Downloads", home),    "/home/alice/Downloads")
+        self.assertEqual(fleet.rebind_path("~bob/Downloads", home), "~bob/Downloads")
+        self.assertEqual(fleet.rebind_path("/tmp", home),           "/tmp")
+        self.assertIsNone(fleet.rebind_path(None, home))
+
+        config = main.Config(
+            [main.FolderTemplate("~/Downloads", ["Music"], "~/Downloads/Folders")],
+            [main.Operation(["~/Downloads"], [main.create_file_rule("~/Downloads/Music", ["mp3"])])]
+        )
+        rebound = fleet.rebind_config(config, home)
+
+        self.assertEqual(rebound.folder_templates[0].root_folder,           "/home/alice/Downloads")
+        self.assertEqual(rebound.folder_templates[0].place_for_unwanted,    "/home/alice/Downloads/Folders")
+        self.assertEqual(rebound.operations[0].scan_sources,                ["/home/alice/Downloads"])
+        self.assertEqual(rebound.operations[0].rules[0].destination,        "/home/alice/Downloads/Music")
+
+        # The template must not be modified
+        self.assertEqual(config.operations[0].rules[0].destination, "~/Downloads/Music")
+
+    def test_fleet_sorts_every_tree(self):
+        '''Every home matched by the root pattern is sorted independently'''
+        import os
+        import tempfile
+
+        config = main.Config(
+            [main.FolderTemplate("~/Downloads", ["Music"])],
+            [main.Operation(["~/Downloads"], [main.create_file_rule("~/Downloads/Music", ["mp3"])])]
+        )
+
+        with tempfile.TemporaryDirectory() as root:
+            for user in ("alice", "bob"):
+                os.makedirs(os.path.join(root, user, "Downloads"))
+                open(os.path.join(root, user, "Downloads", f"{user}.mp3"), "w").close()
+
+            summaries = fleet.run_fleet(config, os.path.join(root, "*"), processes=2)
+
+            self.assertEqual(sorted(summary.home for summary in summaries),
+                [os.path.join(root, "alice"), os.path.join(root, "bob")])
+
+            for user in ("alice", "bob"):
+                self.assertTrue(os.path.exists(os.path.join(root, user, "Downloads", "Music", f"{user}.mp3")))
+
+    def test_fleet_rejects_shared_paths(self):
+        '''Fleet configs may only use paths inside each home'''
+        config = main.Config([], [main.Operation(["~/Downloads"], [main.create_file_rule("/tmp/Music", ["mp3"])])])
+
+        with self.assertRaises(Exception):
+            fleet.run_fleet(config, "/nonexistent/*")
+
+    def test_fleet_stays_inside_home(self):
+        '''Trees are sorted as their owner and symlinks out of a home are not followed'''
+        import os
+        import tempfile
+
+        config = main.Config(
+            [main.FolderTemplate("~/Downloads", ["Music", "Video"])],
+            [main.Operation(["~/Downloads"], [main.create_file_rule("~/Downloads/Music", ["mp3"])])]
+        )
+
+        with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as outside:
+            home = os.path.join(root, "alice")
+            os.makedirs(os.path.join(home, "Downloads"))
+            os.symlink(outside, os.path.join(home, "Downloads", "Music"))
+            open(os.path.join(home, "Downloads", "song.mp3"), "w").close()
+
+            owner = os.geteuid()
+            if owner == 0: # Hand the tree to an unprivileged user
+                owner = 65534
+                os.chmod(root, 0o755)
+                os.chmod(outside, 0o777) # Only the symlink check keeps the file out
+                for (folder, folders, files) in os.walk(home):
+                    for name in [folder] + [os.path.join(folder, entry) for entry in folders + files]:
+                        os.lchown(name, owner, owner)
+
+            (summary,) = fleet.run_fleet(config, os.path.join(root, "*"), processes=1)
+
+            self.assertIsNone(summary.error)
+            self.assertEqual(os.listdir(outside), [])
+            self.assertTrue(os.path.exists(os.path.join(home, "Downloads", "song.mp3")))
+            self.assertEqual(os.stat(os.path.join(home, "Downloads", "Video")).st_uid, owner)
+
+    def test_profiler_counts_fs_calls(self):
+        '''The profiler writes pstats and JSON per stage and restores the wrapped functions'''
+        import os
+        import json
+        import shutil
+        import tempfile
+
+        original_exists = os.path.exists
+
+        with tempfile.TemporaryDirectory() as profile_dir:
+            profiler = profiling.Profiler(profile_dir, [os.path.realpath(main.__file__)])
+            source = os.path.join(profile_dir, "moved.txt")
+            open(source, "w").close()
+
+            def stage():
+                for _ in range(3):
+                    os.path.exists(profile_dir)
+                shutil.move(source, os.path.join(profile_dir, "moved (1).txt"))
+
+            profiler.run("stage", stage)
+            profiler.dump()
+
+            self.assertIs(os.path.exists, original_exists)
+            self.assertTrue(os.path.exists(os.path.join(profile_dir, "stage.pstats")))
+
+            with open(os.path.join(profile_dir, "profile.json"), encoding="UTF-8") as file:
+                stage = json.load(file)["stages"]["stage"]
+
+            # Calls made inside shutil.move are not counted
+            self.assertEqual(stage["fs_calls"]["os.path.exists"], 3)
+            self.assertEqual(stage["fs_calls"]["os.path.isdir"], 0)
+            self.assertEqual(stage["fs_calls"]["os.rename"], 0)
+            self.assertEqual(stage["fs_calls"]["shutil.move"], 1)
+
+            # Folder templates are created relative to open directories
+            template = main.FolderTemplate(os.path.join(profile_dir, "root"), ["Music", "Music/midi"])
+            profiler.run("generate_folders", main.Enforcer(main.Config([template], [])).generate_folders)
+            counts = profiler.stages["generate_folders"]["fs_calls"]
+
+            self.assertEqual(counts["os.makedirs"], 1) # the missing root
+            if main.USE_DIR_FD:
+                self.assertEqual(counts["os.mkdir"], 2)
+                self.assertEqual(counts["os.open"], 2)
+
+    def test_scheduler_lanes_and_priority(self):
+        '''Same device renames go first, transfers are ordered by size, tokens of a source keep their order'''
+        import os
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as root:
+            paths = {}
+            for (name, size) in (("big", 4096), ("small", 16), ("rename", 1)):
+                paths[name] = os.path.join(root, f"{name}.txt")
+                with open(paths[name], "wb") as file:
+                    file.write(b"x" * size)
+
+            folder = lambda name: os.path.join(root, name)
+            tokens = [
+                main.Token(paths["big"],    folder("backup"),   main.COPY),
+                main.Token(paths["small"],  folder("small"),    main.COPY),
+                main.Token(paths["big"],    folder("moved"),    main.MOVE),
+                main.Token(paths["rename"], folder("renamed"),  main.MOVE),
+            ]
+
+            ordered = list(scheduler.Scheduler("small-first").schedule(tokens))
+            self.assertEqual(ordered, [tokens[3], tokens[1], tokens[0], tokens[2]])
+
+            ordered = list(scheduler.Scheduler("fifo").schedule(tokens))
+            self.assertEqual(ordered, [tokens[3], tokens[0], tokens[2], tokens[1]])
+
+        # Only names that can collide keep their order, files with other names into one folder are reordered
+        with tempfile.TemporaryDirectory() as root:
+            tokens = []
+            for (name, size) in (("big", 100000), ("s1", 10), ("s2", 20), ("s1 (1)", 1)): # "s1 (1)" may clash with a copy of "s1"
+                path = os.path.join(root, f"{name}.txt")
+                with open(path, "wb") as file:
+                    file.write(b"x" * size)
+                tokens.append(main.Token(path, os.path.join(root, "archive"), main.COPY))
+
+            ordered = list(scheduler.Scheduler("small-first").schedule(tokens))
+            self.assertEqual(ordered, [tokens[1], tokens[3], tokens[2], tokens[0]])
+
+            ordered = list(scheduler.Scheduler("large-first").schedule(tokens))
+            self.assertEqual(ordered, [tokens[0], tokens[2], tokens[1], tokens[3]])
+
+    def test_scheduler_keeps_outcome(self):
+        '''A copy and a move of one file, colliding with a file of the same name from another source'''
+        import os
+        import io
+        import tempfile
+        import contextlib
+
+        def sort(policy):
+            with tempfile.TemporaryDirectory() as root:
+                folder = lambda name: os.path.join(root, name)
+                for (source, data) in (("A", "a"), ("B", "b")):
+                    os.makedirs(folder(source))
+                    with open(os.path.join(folder(source), "x.mp3"), "w") as file:
+                        file.write(data)
+
+                config = main.Config([], [
+                    main.Operation([folder("A")], [
+                        main.create_file_rule(folder("D"), ["mp3"], action=main.COPY),
+                        main.create_file_rule(folder("E"), ["mp3"]),
+                    ]),
+                    main.Operation([folder("B")], [main.create_file_rule(folder("D"), ["mp3"])]),
+                ])
+                enforcer = main.Enforcer(config, scheduler.Scheduler(policy) if policy else None)
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    enforcer.sort_files()
+                    enforcer.enforce()
+
+                return sorted((os.path.relpath(os.path.join(path, name), root), open(os.path.join(path, name)).read())
+                    for (path, _, files) in os.walk(root) for name in files)
+
+        expected = [("D/x (1).mp3", "b"), ("D/x.mp3", "a"), ("E/x.mp3", "a")]
+        self.assertEqual(sort(None), expected)
+
+        for policy in scheduler.POLICIES:
+            with self.subTest(policy=policy):
+                self.assertEqual(sort(policy), expected)
+
+    def test_scheduler_arguments(self):
+        '''Bad scheduling arguments are reported instead of raising'''
+        import io
+        import os
+        import contextlib
+        from unittest import mock
+
+        config_path = os.path.join(os.path.dirname(os.path.realpath(main.__file__)), "configs", "default.json")
+
+        for param in ("--schedule=foo", "--bandwidth=abc", "--bandwidth=0", "--iops=-1"):
+            with self.subTest(param=param):
+                out = io.StringIO()
+                with contextlib.redirect_stdout(out):
+                    main.main([config_path, "-Q", param])
+
+                self.assertIn("ERROR:", out.getvalue())
+
+        # Only "--schedule" and "--schedule=POLICY" enable the scheduler
+        for (param, policy) in (("--schedule", "small-first"), ("--schedule=fifo", "fifo"), ("--scheduler", None), ("--schedulefoo", None)):
+            with self.subTest(param=param):
+                with mock.patch.object(main, "Enforcer") as enforcer, contextlib.redirect_stdout(io.StringIO()):
+                    main.main([config_path, "-Q", param])
+
+                used = enforcer.call_args[0][1]
+                self.assertEqual(used.policy if used is not None else None, policy)
+
+    def test_scheduler_throttle(self):
+        '''A throttled device waits until the previous transfer's budget is spent'''
+        now = [0.0]
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            now[0] += seconds
+
+        throttle = scheduler.Throttle(scheduler.DeviceLimit(bytes_per_sec=100, iops=10), lambda: now[0], sleep)
+        throttle.wait(200) # 2 seconds of bandwidth
+        throttle.wait(1)   # limited by iops: 0.1 seconds
+        throttle.wait(1)
+
+        self.assertEqual(len(slept), 2)
+        self.assertAlmostEqual(slept[0], 2.0)
+        self.assertAlmostEqual(slept[1], 0.1)
+        self.assertEqual(scheduler.parse_size("50M"), 50 * 1024 ** 2)
+
+    def test_scheduler_physical_order(self):
+        '''The physical policy orders transfers by extent, then inode when the extent is unknown'''
+        import os
+        import types
+        import tempfile
+        from unittest import mock
+
+        extents = {"f0": 300,   "f1": None, "f2": 100,  "f3": None}
+        inodes  = {"f0": 4,     "f1": 50,   "f2": 3,    "f3": 10}
+        real_stat = os.stat
+
+        def fake_stat(path, *args, **kwargs):
+            stat = real_stat(path, *args, **kwargs)
+            name = os.path.basename(str(path))
+            return types.SimpleNamespace(st_dev=stat.st_dev, st_mode=stat.st_mode, st_size=stat.st_size,
+                st_ino=inodes.get(name, stat.st_ino))
+
+        # One folder per file, and every file copied into one folder like a single rule does
+        for destination in (lambda root, name: os.path.join(root, f"copy_{name}"), lambda root, name: os.path.join(root, "archive")):
+            with tempfile.TemporaryDirectory() as root:
+                tokens = []
+                for name in extents:
+                    path = os.path.join(root, name)
+                    open(path, "w").close()
+                    tokens.append(main.Token(path, destination(root, name), main.COPY))
+
+                with mock.patch("os.stat", fake_stat), \
+                     mock.patch.object(scheduler, "first_extent", lambda path: extents[os.path.basename(path)]):
+                    ordered = list(scheduler.Scheduler("physical").schedule(tokens))
+
+            with self.subTest(destination=os.path.basename(tokens[0].destination)):
+                self.assertEqual([os.path.basename(token.source) for token in ordered], ["f2", "f0", "f3", "f1"])
+
+    def test_first_extent(self):
+        '''FIEMAP results are decoded, extents without a known location are ignored'''
+        import tempfile
+        from unittest import mock
+
+        def fiemap(physical, flags):
+            def ioctl(fd, request, buffer):
+                self.assertEqual(request, scheduler.FS_IOC_FIEMAP)
+                self.assertTrue(scheduler.FIEMAP_HEADER.unpack_from(buffer, 0)[2] & scheduler.FIEMAP_FLAG_SYNC)
+                scheduler.FIEMAP_HEADER.pack_into(buffer, 0, 0, 0, 0, 1, 1, 0)
+                scheduler.FIEMAP_EXTENT.pack_into(buffer, scheduler.FIEMAP_HEADER.size, 0, physical, 4096, 0, 0, flags, 0, 0, 0)
+            return mock.Mock(ioctl=ioctl)
+
+        with tempfile.NamedTemporaryFile() as file:
+            with mock.patch.object(scheduler, "fcntl", fiemap(8192, 0)):
+                self.assertEqual(scheduler.first_extent(file.name), 8192)
+
+            with mock.patch.object(scheduler, "fcntl", fiemap(0, scheduler.FIEMAP_EXTENT_DELALLOC)):
+                self.assertIsNone(scheduler.first_extent(file.name))
+
+            with mock.patch.object(scheduler, "fcntl", None):
+                self.assertIsNone(scheduler.first_extent(file.name))
+
+        self.assertIsNone(scheduler.first_extent(tempfile.gettempdir()))
+
+    def test_classify_stream(self):
+        '''Streamed paths follow rule order, stop at the first move and respect scan sources'''
+        import io
+        import json
+
+        config = main.Config([], [
+            main.Operation(["/data/in"], [
+                main.create_file_rule("/data/backup", ["mp3"], action=main.COPY),
+                main.create_file_rule("/data/music",  ["mp3"]),
+                main.create_file_rule("/data/other",  keywords=[""]),
+            ])
+        ])
+
+        self.assertEqual(list(classify.read_paths(io.BytesIO(b"a\0b c\0\0d"), b"\0", chunk_size=2)), ["a", "b c", "d"])
+
+        out = io.StringIO()
+        paths = b"/data/in/song.MP3\n/data/in/notes\n/elsewhere/song.mp3\n"
+        records = classify.run(config, io.BytesIO(paths), out)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+
+        self.assertEqual(records, 3)
+        self.assertEqual([(line["path"], line["rule"], line["action"]) for line in lines], [
+            ("/data/in/song.MP3",   "0:0", main.COPY),
+            ("/data/in/song.MP3",   "0:1", main.MOVE),
+            ("/data/in/notes",      "0:2", main.MOVE),
+        ])
+
+    def test_engines_equivalent(self):
+        '''Alternative engines must sort random trees like the reference pipeline'''
+        for name in [name for name in equivalence.ENGINES if name != "reference"]:
+            for seed in range(25):
+                with self.subTest(engine=name, seed=seed):
+                    equivalence.check_equivalence(equivalence.ENGINES[name], seed)
+
+        # No speedup is reported when nothing was compared, e.g. every seed was skipped
+        import io
+        import contextlib
+        from unittest import mock
+
+        for (runs, check) in ((0, equivalence.check_equivalence), (3, lambda engine, seed: None)):
+            out = io.StringIO()
+            with mock.patch.object(equivalence, "check_equivalence", check), contextlib.redirect_stdout(out):
+                equivalence.compare("classify", runs)
+
+            self.assertIn("speedup n/a", out.getvalue())
+
+    def test_folder_template_materialise(self):
+        '''Templates create only missing folders and nested entries keep their parents wanted'''
+        import os
+        import io
+        import tempfile
+        import contextlib
+
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, "Programs"))
+            os.makedirs(os.path.join(root, "Old stuff"))
+            open(os.path.join(root, "Misc"), "w").close() # a file in the way
+
+            template = main.FolderTemplate(root,
+                ["Programs", "Programs/Python", "Misc/Fonts", "Music/midi/", "Folders"],
+                os.path.join(root, "Folders"))
+
+            self.assertEqual(template.as_tree,
+                {"Programs": {"Python": {}}, "Misc": {"Fonts": {}}, "Music": {"midi": {}}, "Folders": {}})
+
+            enforcer = main.Enforcer(main.Config([template], []))
+            with contextlib.redirect_stdout(io.StringIO()):
+                enforcer.generate_folders()
+                enforcer.sort_folders()
+
+            for folder in ("Programs/Python", "Music/midi", "Folders"):
+                self.assertTrue(os.path.isdir(os.path.join(root, folder)))
+
+            self.assertFalse(os.path.isdir(os.path.join(root, "Misc")))
+            self.assertEqual([(token.source, token.destination) for token in enforcer.tokens],
+                [(os.path.join(root, "Old stuff"), os.path.join(root, "Folders"))])
+
+    def test_folder_template_unreadable(self):
+        '''Folders that cannot be opened or listed are reported and skipped'''
+        import os
+        import io
+        import tempfile
+        import contextlib
+        from unittest import mock
+
+        real_open, real_scandir = os.open, os.scandir
+
+        for locked in ("root", "Programs"):
+            with self.subTest(locked=locked), tempfile.TemporaryDirectory() as parent:
+                root = os.path.join(parent, "root")
+                os.makedirs(os.path.join(root, "Programs"))
+
+                def denied(path):
+                    if isinstance(path, str) and os.path.basename(path) == locked:
+                        raise PermissionError(13, "Permission denied", path)
+
+                def fake_open(path, *args, **kwargs):
+                    denied(path)
+                    return real_open(path, *args, **kwargs)
+
+                def fake_scandir(path="."):
+                    denied(path)
+                    return real_scandir(path)
+
+                template = main.FolderTemplate(root, ["Programs/Python", "Music"])
+                enforcer = main.Enforcer(main.Config([template], []))
+                out = io.StringIO()
+
+                with mock.patch("os.open", fake_open), mock.patch("os.scandir", fake_scandir), contextlib.redirect_stdout(out):
+                    enforcer.generate_folders()
+
+                self.assertIn(f"WARN: Could not create folder: '{os.path.join(root, 'Programs', 'Python')}'", out.getvalue())
+                self.assertFalse(os.path.isdir(os.path.join(root, "Programs", "Python")))
+                self.assertEqual(os.path.isdir(os.path.join(root, "Music")), locked != "root")
+                self.assertEqual(root in enforcer.template_folders, locked != "root")
+
 if __name__ == "__main__":
     import os
     os.chdir(os.path.expanduser("~/Downloads/"))